@@ -0,0 +1,164 @@
+from dataclasses import dataclass, fields, replace
+import json
+import logging
+
+# All the values that affect the results of the pipeline are collected here instead of being spread around
+# the step modules. Feel free to play around with these values and see how it affects the results. Every
+# stage takes a PipelineConfig, so you can also try out different values without editing the source,
+# e.g. by giving main.py a JSON file with --config or by running parameter_sweep.py.
+
+
+@dataclass(frozen=True)
+class PipelineConfig:
+
+    # Image loading (step 1)
+    filter_diameter: int = 9
+    filter_sigma_color: float = 150
+    filter_sigma_space: float = 150
+    max_dimension_size: int = 1024
+
+    # Feature detection and description (step 2). The detector is one of DETECTOR_NAMES, and only the
+    # parameters of that detector are used.
+    detector: str = 'akaze'
+    akaze_response_threshold: float = 0.005
+    akaze_octaves: int = 4
+    akaze_octave_layers: int = 11
+    orb_max_features: int = 2000
+    orb_scale_factor: float = 1.2
+    orb_levels: int = 8
+    brisk_threshold: int = 30
+    brisk_octaves: int = 3
+    sift_max_features: int = 0
+
+    # Image matching (step 3)
+    match_ratio_threshold: float = 0.8
+    ransac_threshold: float = 10.24
+    min_matches_for_homography: int = 10
+    max_homography_total_scaling: float = 100
+    min_homography_total_scaling: float = 0.01
+    max_base_vector_scaling: float = 20
+    min_base_vector_scaling: float = 0.05
+    homography_perspective_limit: float = 0.0025
+
+    # Early rejection. Before running the full pipeline on a target, match the strongest features of
+    # downscaled versions of the model and the target. Targets that don't get at least cascade_min_matches
+    # matches through the ratio test are rejected without running anything else. AKAZE finds far fewer
+    # keypoints in the small images than ORB or BRISK, so it gets a lower threshold of its own here.
+    # With AKAZE the number of keypoints is mostly set by that threshold and the keypoint limits only cap
+    # it on busy images. With ORB and BRISK the limits decide how many keypoints are described.
+    cascade_enabled: bool = False
+    cascade_max_dimension_size: int = 384
+    cascade_akaze_response_threshold: float = 0.002
+    cascade_max_target_keypoints: int = 300
+    cascade_max_model_descriptors: int = 200
+    cascade_match_ratio_threshold: float = 0.75
+    cascade_min_matches: int = 4
+
+
+DEFAULT_CONFIG = PipelineConfig()
+
+# The names in feature_detection_and_description.DETECTORS. They are listed here as well so that the
+# detector can be checked without importing OpenCV.
+DETECTOR_NAMES = ('akaze', 'orb', 'brisk', 'sift')
+
+# Which parameters each stage depends on. A stage only needs to be re-run if one of its own parameters,
+# or a parameter of a stage before it, changes. parameter_sweep.py uses these to reuse earlier results.
+LOADING_PARAMETERS = (
+    'filter_diameter',
+    'filter_sigma_color',
+    'filter_sigma_space',
+    'max_dimension_size',
+)
+# Only the parameters of the chosen detector are used, see get_used_parameter_names.
+DETECTOR_PARAMETERS = {
+    'akaze': (
+        'akaze_response_threshold',
+        'akaze_octaves',
+        'akaze_octave_layers',
+    ),
+    'orb': (
+        'orb_max_features',
+        'orb_scale_factor',
+        'orb_levels',
+    ),
+    'brisk': (
+        'brisk_threshold',
+        'brisk_octaves',
+    ),
+    'sift': (
+        'sift_max_features',
+    ),
+}
+EXTRACTION_PARAMETERS = ('detector',) + tuple(name for names in DETECTOR_PARAMETERS.values() for name in names)
+RATIO_FILTERING_PARAMETERS = (
+    'match_ratio_threshold',
+)
+HOMOGRAPHY_PARAMETERS = (
+    'ransac_threshold',
+    'min_matches_for_homography',
+    'max_homography_total_scaling',
+    'min_homography_total_scaling',
+    'max_base_vector_scaling',
+    'min_base_vector_scaling',
+    'homography_perspective_limit',
+)
+# The early rejection depends on the extraction parameters (through the detector) and on its own
+# parameters. None of the later stages depend on it, since it either stops the pipeline or lets it
+# run exactly as it would without it.
+CASCADE_PARAMETERS = (
+    'cascade_enabled',
+    'cascade_max_dimension_size',
+    'cascade_akaze_response_threshold',
+    'cascade_max_target_keypoints',
+    'cascade_max_model_descriptors',
+    'cascade_match_ratio_threshold',
+    'cascade_min_matches',
+)
+
+
+def parameter_values(config: PipelineConfig, parameter_names):
+    return tuple(getattr(config, name) for name in parameter_names)
+
+
+def get_used_parameter_names(config: PipelineConfig, parameter_names):
+
+    # Leaves out the parameters that can't change the result with this configuration: those of the other
+    # detectors, and those of the early rejection when it is disabled. Since detector and cascade_enabled
+    # are never left out, two configurations with the same used values always give the same result.
+    unused_names = set()
+    for detector, detector_parameter_names in DETECTOR_PARAMETERS.items():
+        if detector != config.detector:
+            unused_names.update(detector_parameter_names)
+    if config.detector != 'akaze':
+        unused_names.add('cascade_akaze_response_threshold')
+    if not config.cascade_enabled:
+        unused_names.update(name for name in CASCADE_PARAMETERS if name != 'cascade_enabled')
+    return tuple(name for name in parameter_names if name not in unused_names)
+
+
+def config_from_dict(values: dict, base: PipelineConfig = DEFAULT_CONFIG):
+
+    known_names = set(field.name for field in fields(PipelineConfig))
+    unknown_names = set(values) - known_names
+    if unknown_names:
+        raise ValueError("Unknown configuration parameters: {}".format(", ".join(sorted(unknown_names))))
+    config = replace(base, **values)
+    if config.detector not in DETECTOR_NAMES:
+        raise ValueError("Unknown detector {}. Choose one of: {}".format(config.detector, ", ".join(DETECTOR_NAMES)))
+    return config
+
+
+def config_to_dict(config: PipelineConfig):
+    return {field.name: getattr(config, field.name) for field in fields(PipelineConfig)}
+
+
+def load_config(path: str):
+
+    logging.debug("load_config: Loading configuration from {}".format(path))
+    with open(path) as config_file:
+        return config_from_dict(json.load(config_file))
+
+
+def save_config(config: PipelineConfig, path: str):
+    with open(path, 'w') as config_file:
+        json.dump(config_to_dict(config), config_file, indent=4, sort_keys=True)
@@ -0,0 +1,79 @@
+from config import DEFAULT_CONFIG, PipelineConfig
+import cv2
+from dataclasses import replace
+from feature_detection_and_description import create_detector
+import image_matching
+import logging
+
+# Most of the time in the pipeline goes into filtering, feature extraction, and matching at full resolution.
+# If most targets don't contain the model at all, that time is mostly wasted. The functions here do a much
+# cheaper version of the same thing: match a limited number of the strongest features from downscaled
+# versions of the model and the target. If even the best model features find almost nothing, the full
+# pipeline wouldn't find a match either and the target can be rejected right away.
+
+
+def downscale_gray_scale_image(img, max_dimension_size: int):
+
+    # No bilateral filter here. Shrinking with area interpolation averages neighbouring pixels, which
+    # already gets rid of most of the noise, and filtering the full size image would cost more than
+    # everything else in the early rejection together.
+    height, width = img.shape[:2]
+    scale_factor = float(max_dimension_size) / float(max(height, width))
+    if scale_factor >= 1.0:
+        return img
+    return cv2.resize(img, None, fx=scale_factor, fy=scale_factor, interpolation=cv2.INTER_AREA)
+
+
+# ORB and BRISK find their keypoints with the cheap FAST corner detector, so for them it pays off to only
+# describe the strongest keypoints. AKAZE and SIFT build the same scale space for detecting and for
+# describing, and doing the two separately would build it twice.
+SEPARATELY_DESCRIBED_DETECTORS = ('orb', 'brisk')
+
+
+def get_strongest_descriptors(img, max_keypoints: int, config: PipelineConfig = DEFAULT_CONFIG):
+
+    # The response of a keypoint tells how strongly the detector reacted to it. Strong keypoints are the
+    # ones most likely to be found again in the other image, so only their descriptors are kept.
+    detector = create_detector(replace(config, akaze_response_threshold=config.cascade_akaze_response_threshold))
+    if config.detector in SEPARATELY_DESCRIBED_DETECTORS:
+        keypoints = detector.detect(img, None)
+        keypoints = sorted(keypoints, key=lambda keypoint: keypoint.response, reverse=True)[:max_keypoints]
+        keypoints, descriptors = detector.compute(img, keypoints)
+    else:
+        keypoints, descriptors = detector.detectAndCompute(img, None)
+        strongest_indices = sorted(range(len(keypoints)), key=lambda index: keypoints[index].response, reverse=True)[:max_keypoints]
+        keypoints = [keypoints[index] for index in strongest_indices]
+        if descriptors is not None:
+            descriptors = descriptors[strongest_indices]
+    logging.debug("Kept the descriptors of the {} strongest keypoints".format(len(keypoints)))
+    return descriptors
+
+
+def get_early_rejection_model_descriptors(raw_model_image, config: PipelineConfig = DEFAULT_CONFIG):
+
+    # The model is described at the same small size as the targets, so that the features of both are
+    # roughly at the same scale. This only needs to be done once per model.
+    small_model_image = downscale_gray_scale_image(raw_model_image, config.cascade_max_dimension_size)
+    return get_strongest_descriptors(small_model_image, config.cascade_max_model_descriptors, config)
+
+
+def get_early_rejection_target_descriptors(raw_target_image, config: PipelineConfig = DEFAULT_CONFIG):
+    small_target_image = downscale_gray_scale_image(raw_target_image, config.cascade_max_dimension_size)
+    return get_strongest_descriptors(small_target_image, config.cascade_max_target_keypoints, config)
+
+
+def passes_early_rejection(model_descriptors, raw_target_image, config: PipelineConfig = DEFAULT_CONFIG):
+    target_descriptors = get_early_rejection_target_descriptors(raw_target_image, config)
+    return has_enough_early_rejection_matches(model_descriptors, target_descriptors, config)
+
+
+def has_enough_early_rejection_matches(model_descriptors, target_descriptors, config: PipelineConfig = DEFAULT_CONFIG):
+
+    # The target descriptors can be calculated once and then checked against several models.
+    unfiltered_matches = image_matching.do_2_nn_brute_force_matching(model_descriptors, target_descriptors)
+    ratio_config = replace(config, match_ratio_threshold=config.cascade_match_ratio_threshold)
+    ratio_filtered_matches = image_matching.do_2_nn_ratio_filtering(unfiltered_matches, ratio_config)
+    if len(ratio_filtered_matches) < config.cascade_min_matches:
+        logging.info("Early rejection: {} matches found, requires at least {}".format(len(ratio_filtered_matches), config.cascade_min_matches))
+        return False
+    return True
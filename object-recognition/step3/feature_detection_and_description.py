@@ -1,12 +1,8 @@
+from config import DEFAULT_CONFIG, PipelineConfig
 import cv2
 import logging
 
-# Feel free to play around with these values and see how it affects the results.
-AKAZE_RESPONSE_THRESHOLD = 0.005
-AKAZE_OCTAVES = 4
-AKAZE_OCTAVE_LAYERS = 11
-
-def get_akaze_keypoints_and_descriptors(img):
+def create_akaze(config: PipelineConfig):
 
     # There is no short and easy way to describe AKAZE. If you really want to understand it, the paper
     # can be found here: http://www.bmva.org/bmvc/2013/Papers/paper0013/paper0013.pdf.
@@ -15,11 +11,77 @@ def get_akaze_keypoints_and_descriptors(img):
     # An important part of AKAZE descriptors is that they are scale and rotation invariant, i.e. when
     # matching features the size and orientation of the features in each image doesn't effect the matching.
     logging.debug("Creating AKAZE with threshold {}, {} octaves, and {} octave layers".format(
-        AKAZE_RESPONSE_THRESHOLD, AKAZE_OCTAVES, AKAZE_OCTAVE_LAYERS
+        config.akaze_response_threshold, config.akaze_octaves, config.akaze_octave_layers
+    ))
+    return cv2.AKAZE_create(cv2.AKAZE_DESCRIPTOR_MLDB, 0, 3, config.akaze_response_threshold, config.akaze_octaves, config.akaze_octave_layers)
+
+
+def create_orb(config: PipelineConfig):
+
+    # ORB finds corners with FAST and describes them with a rotated version of BRIEF, which only compares
+    # the brightness of pairs of pixels. This makes it a lot cheaper than AKAZE, at the cost of being less
+    # robust to changes in scale. https://docs.opencv.org/4.1.0/d1/d89/tutorial_py_orb.html
+    logging.debug("Creating ORB with {} max features, scale factor {}, and {} levels".format(
+        config.orb_max_features, config.orb_scale_factor, config.orb_levels
     ))
-    akaze = cv2.AKAZE_create(cv2.AKAZE_DESCRIPTOR_MLDB, 0, 3, AKAZE_RESPONSE_THRESHOLD, AKAZE_OCTAVES, AKAZE_OCTAVE_LAYERS)
+    return cv2.ORB_create(config.orb_max_features, config.orb_scale_factor, config.orb_levels)
+
+
+def create_brisk(config: PipelineConfig):
+
+    # BRISK is also built on FAST corners and binary descriptors, but samples the pixel pairs in a
+    # circular pattern. https://docs.opencv.org/4.1.0/de/dbf/classcv_1_1BRISK.html
+    logging.debug("Creating BRISK with threshold {} and {} octaves".format(config.brisk_threshold, config.brisk_octaves))
+    return cv2.BRISK_create(config.brisk_threshold, config.brisk_octaves)
+
+
+def create_sift(config: PipelineConfig):
+
+    # SIFT is the classic scale invariant detector/descriptor. Its descriptors are vectors of floats instead
+    # of binary strings. It was patented until 2020, so depending on your OpenCV version it is either part
+    # of the main module, only in the contrib package, or not available at all.
+    # https://docs.opencv.org/4.1.0/da/df5/tutorial_py_sift_intro.html
+    logging.debug("Creating SIFT with {} max features".format(config.sift_max_features))
+    if hasattr(cv2, 'SIFT_create'):
+        return cv2.SIFT_create(config.sift_max_features)
+    return cv2.xfeatures2d.SIFT_create(config.sift_max_features)
+
+
+# All the detectors that can be chosen with the detector parameter. They all produce keypoints and
+# descriptors in the same format, so the rest of the pipeline doesn't need to care which one is used.
+DETECTORS = {
+    'akaze': create_akaze,
+    'orb': create_orb,
+    'brisk': create_brisk,
+    'sift': create_sift,
+}
+
+
+def get_available_detectors():
+
+    available_detectors = []
+    for name, create_detector in DETECTORS.items():
+        try:
+            create_detector(DEFAULT_CONFIG)
+        except (AttributeError, cv2.error):
+            logging.debug("Detector {} is not available in this OpenCV build".format(name))
+            continue
+        available_detectors.append(name)
+    return available_detectors
+
+
+def create_detector(config: PipelineConfig = DEFAULT_CONFIG):
+
+    if config.detector not in DETECTORS:
+        raise ValueError("Unknown detector {}. Choose one of: {}".format(config.detector, ", ".join(DETECTORS)))
+    return DETECTORS[config.detector](config)
+
+
+def get_keypoints_and_descriptors(img, config: PipelineConfig = DEFAULT_CONFIG):
+
+    detector = create_detector(config)
     # Keypoints and descriptors can be calculated separately, but since they both require the same initial calculations
     # doing it in one go saves time.
-    keypoints, descriptors = akaze.detectAndCompute(img, None)
+    keypoints, descriptors = detector.detectAndCompute(img, None)
     logging.debug("Found {} keypoints".format(len(keypoints)))
     return keypoints, descriptors
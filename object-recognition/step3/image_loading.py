@@ -1,15 +1,14 @@
+from config import DEFAULT_CONFIG, PipelineConfig
 import cv2
 import logging
 
-FILTER_DIAMETER = 9
-FILTER_SIGMA_COLOR = 150
-FILTER_SIGMA_SPACE = 150
-MAX_DIMENSION_SIZE = 1024
+def read_gray_scale_image(path: str):
+    logging.debug("read_gray_scale_image: Called to read image from path {}".format(path))
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
 
-def load_gray_scale_image(path: str):
 
-    logging.debug("load_gray_scale_image: Called to load image from path {}".format(path))
-    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+def preprocess_gray_scale_image(img, config: PipelineConfig = DEFAULT_CONFIG):
+
     original_height, original_width = img.shape[:2]
     logging.debug("Original height: {}. Original width: {}.".format(original_height, original_width))
 
@@ -17,11 +16,11 @@ def load_gray_scale_image(path: str):
     # sharp, which helps later in the process.
     # For a fuller explanation see https://docs.opencv.org/4.1.0/d4/d13/tutorial_py_filtering.html and
     # https://docs.opencv.org/4.1.0/d4/d86/group__imgproc__filter.html#ga9d7064d478c95d60003cf839430737ed
-    filtered_img = cv2.bilateralFilter(img, FILTER_DIAMETER, FILTER_SIGMA_COLOR, FILTER_SIGMA_SPACE)
+    filtered_img = cv2.bilateralFilter(img, config.filter_diameter, config.filter_sigma_color, config.filter_sigma_space)
 
-    # Calculate how much to scale the image up or down. MAX_DIMENSION_SIZE tells us how long the longest side of
+    # Calculate how much to scale the image up or down. config.max_dimension_size tells us how long the longest side of
     # the image should be after scaling. This gives us some consistency between images.
-    scale_factor = float(MAX_DIMENSION_SIZE) / float(original_width if original_width > original_height else original_width)
+    scale_factor = float(config.max_dimension_size) / float(original_width if original_width > original_height else original_width)
     logging.debug("Calculated scale factor: {}".format(scale_factor))
     if scale_factor == 1.0:
         return filtered_img
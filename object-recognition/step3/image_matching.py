@@ -1,32 +1,41 @@
+from config import DEFAULT_CONFIG, PipelineConfig
 import cv2
+import instrumentation
 import logging
 import math
 import numpy as np
 
-MATCH_RATIO_THRESHOLD = 0.8
-RANSAC_THRESHOLD = 10.24
-MIN_MATCHES_FOR_HOMOGRAPHY = 10
-MAX_HOMOGRAPHY_TOTAL_SCALING = 100
-MIN_HOMOGRAPHY_TOTAL_SCALING = 0.01
-MAX_BASE_VECTOR_SCALING = 20
-MIN_BASE_VECTOR_SCALING = 0.05
-HOMOGRAPHY_PERSPECTIVE_LIMIT = 0.0025
 
+def get_matcher_norm(descriptors):
 
-def do_2_nn_brute_force_matching_hamming(model_descriptors, target_descriptors):
-
-    # Since AKAZE uses binary string based descriptors, we need to use Hamming distance
-    # for matching.
+    # Binary descriptors (AKAZE, ORB, BRISK) are stored as bytes and are compared by counting the bits
+    # that differ, i.e. the Hamming distance. Float descriptors (SIFT) are vectors and are compared with
+    # the usual Euclidean (L2) distance.
     # https://docs.opencv.org/4.1.0/dc/dc3/tutorial_py_matcher.html
-    matcher = cv2.DescriptorMatcher_create(cv2.DescriptorMatcher_BRUTEFORCE_HAMMING)
+    if descriptors.dtype == np.uint8:
+        return cv2.NORM_HAMMING
+    return cv2.NORM_L2
+
+
+def do_2_nn_brute_force_matching(model_descriptors, target_descriptors):
+
+    # If no keypoints were found in one of the images, there are no descriptors to match.
+    if model_descriptors is None or target_descriptors is None:
+        logging.debug("No descriptors to match")
+        return []
+
+    matcher = cv2.BFMatcher(get_matcher_norm(model_descriptors))
     # We search for the 2 best matches (nearest neighbors) for each point. We can
     # then later filter matches by comparing the 2 best matches to each other.
     matches_2_nn = matcher.knnMatch(target_descriptors, model_descriptors, 2)
+    # If the model image has less than 2 descriptors, some points won't have a second nearest neighbour
+    # to compare against in the ratio test.
+    matches_2_nn = [matches for matches in matches_2_nn if len(matches) == 2]
     logging.debug("Brute Force Matcher found {} matches".format(len(matches_2_nn)))
     return matches_2_nn
 
 
-def do_2_nn_ratio_filtering(unfiltered_2_nn_matches):
+def do_2_nn_ratio_filtering(unfiltered_2_nn_matches, config: PipelineConfig = DEFAULT_CONFIG):
 
     logging.debug("Matches before ratio filtering: {}".format(len(unfiltered_2_nn_matches)))
     good_matches = []
@@ -35,7 +44,7 @@ def do_2_nn_ratio_filtering(unfiltered_2_nn_matches):
     # unambiguously match it to a specific feature in the model image.
     # https://docs.opencv.org/4.1.0/d5/d6f/tutorial_feature_flann_matcher.html
     for nearest_neighbour, second_nearest_neigbour in unfiltered_2_nn_matches:
-        if nearest_neighbour.distance < MATCH_RATIO_THRESHOLD * second_nearest_neigbour.distance:
+        if nearest_neighbour.distance < config.match_ratio_threshold * second_nearest_neigbour.distance:
             good_matches.append(nearest_neighbour)
     logging.debug("Matches after ratio filtering: {}".format(len(good_matches)))
     return good_matches
@@ -70,7 +79,12 @@ def remove_duplicate_mappings(matches):
     return best_matches
 
 
-def filter_with_homography(matches, model_keypoints, target_keypoints):
+def filter_with_homography(matches, model_keypoints, target_keypoints, config: PipelineConfig = DEFAULT_CONFIG):
+    filtered_matches, homography = filter_with_homography_and_get_homography(matches, model_keypoints, target_keypoints, config)
+    return filtered_matches
+
+
+def filter_with_homography_and_get_homography(matches, model_keypoints, target_keypoints, config: PipelineConfig = DEFAULT_CONFIG):
 
     # This function is based on the properties of transformation matrices. If you are not
     # familiar or just rusty, I suggest taking a quick look at the following things:
@@ -82,9 +96,10 @@ def filter_with_homography(matches, model_keypoints, target_keypoints):
     # If you calculate a valid homography with a low number of matches, it is hard to say if
     # it is because the images match or just because of luck (consider that you can calculate
     # it with just 4 points).
-    if len(matches) < MIN_MATCHES_FOR_HOMOGRAPHY:
-        logging.info("Not enough matches for homography. {} matches given, requires at least {}".format(len(matches), MIN_MATCHES_FOR_HOMOGRAPHY))
-        return []
+    if len(matches) < config.min_matches_for_homography:
+        logging.info("Not enough matches for homography. {} matches given, requires at least {}".format(len(matches), config.min_matches_for_homography))
+        instrumentation.increment('rejections.too_few_matches')
+        return [], None
 
     logging.debug("Matches before homography: {}".format(len(matches)))
     target_keypoint_positions = np.float32([target_keypoints[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
@@ -94,12 +109,13 @@ def filter_with_homography(matches, model_keypoints, target_keypoints):
 
     # We use RANSAC (https://en.wikipedia.org/wiki/Random_sample_consensus) to obtain more robust results
     # Docs: https://docs.opencv.org/4.1.0/d9/d0c/group__calib3d.html#ga4abc2ece9fab9398f2e560d53c8c9780
-    homography, mask = cv2.findHomography(target_keypoint_positions, model_keypoint_positions, cv2.RANSAC, RANSAC_THRESHOLD)
+    homography, mask = cv2.findHomography(target_keypoint_positions, model_keypoint_positions, cv2.RANSAC, config.ransac_threshold)
 
     logging.debug("Homography:\n{}".format(homography))
-    if homography.size == 0:
+    if homography is None or homography.size == 0:
         logging.error("Failed to obtain any homography")
-        return filtered_matches
+        instrumentation.increment('rejections.no_homography')
+        return filtered_matches, None
 
     # The following checks are all about how the homography transforms the target image. For us to
     # trust that the homography works because the model has been found in the target image,
@@ -112,9 +128,10 @@ def filter_with_homography(matches, model_keypoints, target_keypoints):
     # in either direction.
     determinant = (homography[0, 0] * homography[1, 1]) - (homography[0, 1] * homography[1, 0])
     logging.debug("Determinant: {}".format(determinant))
-    if determinant > MAX_HOMOGRAPHY_TOTAL_SCALING or determinant < MIN_HOMOGRAPHY_TOTAL_SCALING:
+    if determinant > config.max_homography_total_scaling or determinant < config.min_homography_total_scaling:
         logging.info("Calculated homography has a determinant outside allowed values")
-        return filtered_matches
+        instrumentation.increment('rejections.determinant')
+        return filtered_matches, None
 
     # Here we check how much each basis vector (https://en.wikipedia.org/wiki/Basis_(linear_algebra))
     # is scaled during transformation (the columns of the upper left 2 x 2 matrix give the basis vectors; 
@@ -123,21 +140,24 @@ def filter_with_homography(matches, model_keypoints, target_keypoints):
     # up while the other is scaled down.
     x_basis_scaling = math.sqrt(math.pow(homography[0, 0], 2) + math.pow(homography[1, 0], 2))
     logging.debug("X-basis scaling: {}".format(x_basis_scaling))
-    if x_basis_scaling > MAX_BASE_VECTOR_SCALING or x_basis_scaling < MIN_BASE_VECTOR_SCALING:
+    if x_basis_scaling > config.max_base_vector_scaling or x_basis_scaling < config.min_base_vector_scaling:
         logging.info("Calculated homography scales x-basis vector beyond trusted limits.")
-        return filtered_matches
+        instrumentation.increment('rejections.x_basis_scaling')
+        return filtered_matches, None
     y_basis_scaling = math.sqrt(math.pow(homography[0, 1], 2) + math.pow(homography[1, 1], 2))
     logging.debug("Y-basis scaling: {}".format(y_basis_scaling))
-    if y_basis_scaling > MAX_BASE_VECTOR_SCALING or y_basis_scaling < MIN_BASE_VECTOR_SCALING:
+    if y_basis_scaling > config.max_base_vector_scaling or y_basis_scaling < config.min_base_vector_scaling:
         logging.info("Calculated homography scales y-basis vector beyond trusted limits.")
-        return filtered_matches
+        instrumentation.increment('rejections.y_basis_scaling')
+        return filtered_matches, None
 
     # For us to trust the homography, it should also have very low levels of perspectivity.
     perspectivity = math.sqrt(math.pow(homography[2, 0], 2) + math.pow(homography[2, 1], 2))
     logging.debug("Perspectivity: {}".format(perspectivity))
-    if perspectivity > HOMOGRAPHY_PERSPECTIVE_LIMIT:
+    if perspectivity > config.homography_perspective_limit:
         logging.info("Calculated homography distorts perspective beyond trusted bounds.")
-        return filtered_matches
+        instrumentation.increment('rejections.perspectivity')
+        return filtered_matches, None
 
     # Check against mask to only keep matches that weren't filtered out by RANSAC.
     for i, match in enumerate(matches):
@@ -145,4 +165,5 @@ def filter_with_homography(matches, model_keypoints, target_keypoints):
             filtered_matches.append(match)
     logging.debug("Matches after homography: {}".format(len(filtered_matches)))
 
-    return filtered_matches
+    # The homography maps points in the target image to points in the model image.
+    return filtered_matches, homography
@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+# Simple timers and counters for seeing where the time goes. Timings are collected per name, so running
+# the same stage several times adds up. This module deliberately doesn't import OpenCV or NumPy, so it can
+# be used to time how long importing them takes.
+
+_timings = {}
+_counters = {}
+# Stages may run in several threads at once (see pipeline.find_best_model_in_target).
+_lock = threading.Lock()
+
+
+@contextmanager
+def timed(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_duration(name, time.perf_counter() - start)
+
+
+def record_duration(name: str, seconds: float):
+    with _lock:
+        total, count = _timings.get(name, (0.0, 0))
+        _timings[name] = (total + seconds, count + 1)
+
+
+def increment(name: str, amount: int = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def merge(timings: dict, counters: dict):
+
+    # Adds timings and counters collected elsewhere, e.g. in a worker process, to the ones collected here.
+    with _lock:
+        for name, (total, count) in timings.items():
+            previous_total, previous_count = _timings.get(name, (0.0, 0))
+            _timings[name] = (previous_total + total, previous_count + count)
+        for name, value in counters.items():
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def get_timings():
+    with _lock:
+        return dict(_timings)
+
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+
+
+def log_report():
+
+    timings = get_timings()
+    counters = get_counters()
+    logging.info("Timings:")
+    for name, (total, count) in sorted(timings.items()):
+        logging.info("  {:<40} {:10.2f} ms total {:10.2f} ms mean ({} calls)".format(name, total * 1000, total * 1000 / count, count))
+    if counters:
+        logging.info("Counters:")
+        for name, value in sorted(counters.items()):
+            logging.info("  {:<40} {:10}".format(name, value))
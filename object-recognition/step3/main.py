@@ -1,13 +1,64 @@
+import time
+STARTUP_TIME = time.perf_counter()
+
 import argparse
-import cv2
-from feature_detection_and_description import get_akaze_keypoints_and_descriptors
-from image_loading import load_gray_scale_image
-import image_matching
+from config import DEFAULT_CONFIG, PipelineConfig, load_config
+import instrumentation
 import logging
-import numpy as np
+import multiprocessing
+import os
+import result_cache
 import sys
 
-def find_model_in_target(path_to_model: str, path_to_target: str):
+# Importing OpenCV and NumPy takes a noticeable amount of time compared to running the pipeline on a
+# single small image. That's why they are only imported once the arguments have been checked, and only
+# by the functions that need them. Running with --help or with bad arguments never imports them.
+
+# The configuration and the model prepared by the parent process when running with --preload. Worker
+# processes are forked after it has been set, so they get a copy of it without having to calculate or
+# transfer it.
+_preloaded_model = None
+
+
+def import_pipeline():
+    if 'pipeline' in sys.modules:
+        return sys.modules['pipeline']
+    with instrumentation.timed('startup.imports'):
+        import pipeline
+    return pipeline
+
+
+def get_process_age():
+
+    # Returns how many seconds ago the process was started, or None if that can't be found out. This
+    # includes starting the interpreter, which happens before the first line of this file is run. On Linux
+    # /proc/self/stat tells when the process was started, in clock ticks (usually 10 ms) since boot.
+    try:
+        with open('/proc/self/stat') as stat_file:
+            # The command name in parentheses may contain spaces, so the fields are counted after it. The
+            # start time is the 22nd field, and the one after the parentheses is the 3rd.
+            start_ticks = int(stat_file.read().rsplit(')', 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, AttributeError, ValueError, IndexError):
+        return None
+
+
+def record_startup_time():
+
+    # Startup is counted from the start of the process until the model is prepared, i.e. until everything
+    # that doesn't depend on the target is done. This is the same in every mode, so the numbers can be
+    # compared. Where the start of the process isn't known, only the time since the start of this file
+    # can be measured, and it is recorded under a different name so it isn't mistaken for the total.
+    time_since_main = time.perf_counter() - STARTUP_TIME
+    process_age = get_process_age()
+    if process_age is None:
+        instrumentation.record_duration('startup.since_main', time_since_main)
+        return
+    instrumentation.record_duration('startup.interpreter', max(process_age - time_since_main, 0.0))
+    instrumentation.record_duration('startup.total', process_age)
+
+
+def find_model_in_target(path_to_model: str, path_to_target: str, config: PipelineConfig = DEFAULT_CONFIG):
 
     logging.debug("find_model_in_target: Called with path_to_model = {} and path_to_target = {}".format(path_to_model, path_to_target))
     
@@ -24,8 +75,10 @@ def find_model_in_target(path_to_model: str, path_to_target: str):
     #    discrepancies when trying to find prominent features. Smoothing with OpenCV:
     #    https://docs.opencv.org/3.1.0/d4/d13/tutorial_py_filtering.html
 
-    model_image = load_gray_scale_image(path_to_model)
-    target_image = load_gray_scale_image(path_to_target)
+    pipeline = import_pipeline()
+
+    raw_model_image = pipeline.read_image(path_to_model)
+    model_image = pipeline.preprocess_image(raw_model_image, config)
 
     # STEP 2
     # Once you have read your images as gray-scale it is time to extract interesting
@@ -39,8 +92,19 @@ def find_model_in_target(path_to_model: str, path_to_target: str):
     # Useful stuff:
     # https://docs.opencv.org/4.1.0/db/d27/tutorial_py_table_of_contents_feature2d.html
 
-    model_keypoints, model_descriptors = get_akaze_keypoints_and_descriptors(model_image)
-    target_keypoints, target_descriptors = get_akaze_keypoints_and_descriptors(target_image)
+    model_keypoints, model_descriptors = pipeline.extract_features(model_image, config)
+    early_rejection_model_descriptors = pipeline.prepare_early_rejection(raw_model_image, config)
+    record_startup_time()
+
+    # If early rejection is enabled, a quick look at a small version of the target is enough to skip
+    # targets that clearly don't contain the model. Only the targets that pass are processed in full.
+    raw_target_image = pipeline.read_image(path_to_target)
+    if not pipeline.passes_early_rejection(early_rejection_model_descriptors, raw_target_image, config):
+        log_result(path_to_target, 0)
+        return []
+
+    target_image = pipeline.preprocess_image(raw_target_image, config)
+    target_keypoints, target_descriptors = pipeline.extract_features(target_image, config)
 
     # STEP 3
     # With descriptors in hand it is now possible to actually try and match images.
@@ -65,11 +129,12 @@ def find_model_in_target(path_to_model: str, path_to_target: str):
     # https://docs.opencv.org/4.1.0/d1/de0/tutorial_py_feature_homography.html
     # https://docs.opencv.org/4.1.0/d7/dff/tutorial_feature_homography.html
 
-    unfiltered_matches = image_matching.do_2_nn_brute_force_matching_hamming(model_descriptors, target_descriptors)
-    ratio_filtered_matches = image_matching.do_2_nn_ratio_filtering(unfiltered_matches)
-    duplicate_filtered_matches = image_matching.remove_duplicate_mappings(ratio_filtered_matches)
-    homography_filtered_matches = image_matching.filter_with_homography(duplicate_filtered_matches, model_keypoints, target_keypoints)
+    unfiltered_matches, ratio_filtered_matches, duplicate_filtered_matches, homography_filtered_matches, homography = pipeline.match_features(
+        model_keypoints, model_descriptors, target_keypoints, target_descriptors, config
+    )
+    log_result(path_to_target, len(homography_filtered_matches))
 
+    import cv2
     draw_matches("Homography filtered matches: {}".format(len(homography_filtered_matches)), homography_filtered_matches, target_image, target_keypoints, model_image, model_keypoints)
     draw_matches("Duplicate filtered matches: {}".format(len(duplicate_filtered_matches)), duplicate_filtered_matches, target_image, target_keypoints, model_image, model_keypoints)
     draw_matches("Ratio filtered matches: {}".format(len(ratio_filtered_matches)), ratio_filtered_matches, target_image, target_keypoints, model_image, model_keypoints)
@@ -78,11 +143,95 @@ def find_model_in_target(path_to_model: str, path_to_target: str):
     cv2.waitKey(0)
     cv2.destroyAllWindows()
 
-    return
+    return homography_filtered_matches
+
+
+def log_result(path_to_target: str, match_count: int):
+    if match_count > 0:
+        logging.info("Found model in {} with {} matches".format(path_to_target, match_count))
+    else:
+        logging.info("Did not find model in {}".format(path_to_target))
+
+
+def find_preloaded_model_in_target(path_to_target: str):
+
+    config, model = _preloaded_model
+    logging.debug("find_preloaded_model_in_target: Called with path_to_target = {}".format(path_to_target))
+    try:
+        pipeline = import_pipeline()
+        result = pipeline.verify_model_in_target(model, path_to_target, config)
+    except:
+        logging.exception('Unexpected exception occured while processing {}!'.format(path_to_target))
+        return path_to_target, None
+    log_result(path_to_target, result['inlier_count'])
+    return path_to_target, result
+
+
+def find_preloaded_model_in_target_in_worker(path_to_target: str):
+
+    # Timings and counters collected in a worker process would be lost with it, so they are sent back
+    # to the parent along with the result.
+    instrumentation.reset()
+    result = find_preloaded_model_in_target(path_to_target)
+    return result, instrumentation.get_timings(), instrumentation.get_counters()
+
+
+def find_model_in_targets(path_to_model: str, paths_to_targets, config: PipelineConfig, worker_count: int = None):
+
+    # Do all the work that is the same for every target once, in this process, and only then start the
+    # workers. Since they are forked from this process, they start with OpenCV already imported and the
+    # model keypoints and descriptors already calculated. Without a worker count the targets are handled
+    # in this process.
+    global _preloaded_model
+    pipeline = import_pipeline()
+    with instrumentation.timed('startup.model_preparation'):
+        _preloaded_model = (config, pipeline.prepare_model(path_to_model, config))
+    record_startup_time()
+
+    if worker_count is None:
+        return [find_preloaded_model_in_target(path) for path in paths_to_targets]
+
+    # Forking is not available on all platforms (e.g. Windows). There we just handle the targets one by one
+    # in this process, which still avoids paying for the imports and the model more than once.
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        logging.warning("Forking worker processes is not supported on this platform. Processing targets sequentially.")
+        return [find_preloaded_model_in_target(path) for path in paths_to_targets]
+
+    with instrumentation.timed('startup.worker_pool'):
+        pool = multiprocessing.get_context('fork').Pool(worker_count)
+    with pool:
+        with instrumentation.timed('targets'):
+            worker_results = pool.map(find_preloaded_model_in_target_in_worker, paths_to_targets)
+    results = []
+    for result, timings, counters in worker_results:
+        instrumentation.merge(timings, counters)
+        results.append(result)
+    return results
+
+
+def find_best_model_in_target(paths_to_models, path_to_target: str, config: PipelineConfig, thread_count: int, confident_inlier_count: int = None):
+
+    pipeline = import_pipeline()
+    with instrumentation.timed('startup.model_preparation'):
+        models = pipeline.prepare_models(paths_to_models, config, thread_count)
+    record_startup_time()
+
+    with instrumentation.timed('targets'):
+        best_model_path, results = pipeline.find_best_model_in_target(models, path_to_target, config, thread_count, confident_inlier_count)
+    for path_to_model, result in results.items():
+        logging.debug("{}: {} matches".format(path_to_model, result['inlier_count']))
+    if best_model_path is None:
+        logging.info("Did not find any of the {} models in {}".format(len(paths_to_models), path_to_target))
+    else:
+        logging.info("Best match in {} is {} with {} matches".format(path_to_target, best_model_path, results[best_model_path]['inlier_count']))
+    return best_model_path, results
 
 
 def draw_matches(window_name, matches, target_image, target_keypoints, model_image, model_keypoints):
 
+    import cv2
+    import numpy as np
+
     matches_img = np.empty((max(model_image.shape[0], target_image.shape[0]), model_image.shape[1] + target_image.shape[1], 3), dtype=np.uint8)
     cv2.drawMatches(target_image, target_keypoints, model_image, model_keypoints, matches, matches_img, flags=cv2.DrawMatchesFlags_DEFAULT)
     
@@ -109,9 +258,11 @@ if __name__ == '__main__':
     parser.add_argument(
         '-m',
         '--model-path',
-        dest='model_path',
+        dest='model_paths',
         type=str,
-        help='Path to the model image that you are trying to find in the target image.'
+        nargs='+',
+        help='Path to the model image that you are trying to find in the target image. If several paths are given, '
+             'they are all checked against the target in parallel threads and the best match is logged.'
     )
     parser.add_argument(
         '-t',
@@ -120,11 +271,98 @@ if __name__ == '__main__':
         type=str,
         help='Path of the target image in which you are trying to find an object.'
     )
+    parser.add_argument(
+        '-c',
+        '--config',
+        dest='config_path',
+        type=str,
+        help='Path to a JSON file with pipeline parameters, e.g. one written by parameter_sweep.py. Parameters that are not given keep their default values.'
+    )
+    parser.add_argument(
+        '--preload',
+        dest='worker_count',
+        type=int,
+        help='Prepare the model once and then fork this many worker processes to search for it in several targets. '
+             'Target paths are read from standard input, one per line, unless --target-path is given.'
+    )
+    parser.add_argument(
+        '--no-display',
+        dest='display',
+        action='store_false',
+        help='Only log the result instead of showing the matches in windows.'
+    )
+    parser.add_argument(
+        '--cache-size',
+        dest='cache_size',
+        type=int,
+        default=0,
+        help='Keep the results of this many model/target pairs in memory and reuse them when the same pair is seen again.'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        dest='cache_directory',
+        type=str,
+        help='Also store results as files in this directory, so that they can be reused by later runs.'
+    )
+    parser.add_argument(
+        '--threads',
+        dest='thread_count',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of threads to use when checking several models.'
+    )
+    parser.add_argument(
+        '--confident-matches',
+        dest='confident_inlier_count',
+        type=int,
+        help='When checking several models, stop as soon as one is found with at least this many matches.'
+    )
+    parser.add_argument(
+        '--benchmark',
+        dest='benchmark',
+        action='store_true',
+        help='Log how long startup and each step took.'
+    )
     args = parser.parse_args()
-    
+
     configure_logging(args.loglevel)
 
+    # Check everything we can before importing anything heavy.
+    if not args.model_paths:
+        parser.error('the following arguments are required: -m/--model-path')
+    for model_path in args.model_paths:
+        if not os.path.isfile(model_path):
+            parser.error('model image {} does not exist'.format(model_path))
+    several_models = len(args.model_paths) > 1
+    if several_models and args.worker_count is not None:
+        parser.error('--preload can only be used with a single model')
+    if args.thread_count < 1:
+        parser.error('--threads requires at least one thread')
+    if args.worker_count is None and not args.target_path:
+        parser.error('the following arguments are required: -t/--target-path')
+    if args.target_path and not os.path.isfile(args.target_path):
+        parser.error('target image {} does not exist'.format(args.target_path))
+    if args.worker_count is not None and args.worker_count < 1:
+        parser.error('--preload requires at least one worker')
+    if args.cache_size < 0:
+        parser.error('--cache-size can not be negative')
+    if (args.cache_size or args.cache_directory) and args.worker_count is None and args.display and not several_models:
+        parser.error('the result cache is only used with --preload or --no-display')
+    try:
+        config = load_config(args.config_path) if args.config_path else DEFAULT_CONFIG
+    except (OSError, ValueError, TypeError) as e:
+        parser.error('could not read configuration {}: {}'.format(args.config_path, e))
+
     try:
-        find_model_in_target(args.model_path, args.target_path)
+        result_cache.configure_result_cache(args.cache_size, args.cache_directory)
+        if several_models:
+            find_best_model_in_target(args.model_paths, args.target_path, config, args.thread_count, args.confident_inlier_count)
+        elif args.worker_count is None and args.display:
+            find_model_in_target(args.model_paths[0], args.target_path, config)
+        else:
+            paths_to_targets = [args.target_path] if args.target_path else [line.strip() for line in sys.stdin if line.strip()]
+            find_model_in_targets(args.model_paths[0], paths_to_targets, config, args.worker_count)
+        if args.benchmark:
+            instrumentation.log_report()
     except:
         logging.exception('Unexpected exception occured!')
\ No newline at end of file
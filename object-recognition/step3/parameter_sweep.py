@@ -0,0 +1,394 @@
+import argparse
+import config as pipeline_config
+import csv
+from dataclasses import replace
+import early_rejection
+from feature_detection_and_description import get_available_detectors, get_keypoints_and_descriptors
+from image_loading import preprocess_gray_scale_image, read_gray_scale_image
+import image_matching
+import itertools
+import json
+import logging
+from main import configure_logging
+import os
+import random
+import time
+
+# This tool runs the whole pipeline over a set of image pairs for which we already know the right answer,
+# once for every combination of parameters we want to try out. For each combination it measures how long
+# the pipeline took and how often it got the answer right, so that we can pick the fastest parameters that
+# are still accurate enough.
+#
+# The pairs are given as a CSV file with the columns model_path, target_path, and expected_match (1 if the
+# model can be found in the target, otherwise 0). Relative paths are relative to the CSV file.
+#
+# The parameters to try are given as a JSON file that maps parameter names (see config.py) to lists of
+# values, e.g. {"akaze_response_threshold": [0.001, 0.005], "max_dimension_size": [512, 1024]}.
+# Parameters that are not listed keep the values of the base configuration.
+
+# The stages of the pipeline in the order they are run. Each stage is listed with the parameters it
+# depends on. A stage can reuse an earlier result if all its own and all earlier parameters are the same.
+STAGES = (
+    ('loading', pipeline_config.LOADING_PARAMETERS),
+    ('extraction', pipeline_config.EXTRACTION_PARAMETERS),
+    ('matching', ()),
+    ('ratio_filtering', pipeline_config.RATIO_FILTERING_PARAMETERS),
+    ('duplicate_removal', ()),
+    ('homography', pipeline_config.HOMOGRAPHY_PARAMETERS),
+)
+
+
+def load_labelled_pairs(path: str):
+
+    logging.debug("load_labelled_pairs: Loading pairs from {}".format(path))
+    base_directory = os.path.dirname(os.path.abspath(path))
+    pairs = []
+    with open(path, newline='') as pairs_file:
+        for row in csv.DictReader(pairs_file):
+            model_path = os.path.join(base_directory, row['model_path'])
+            target_path = os.path.join(base_directory, row['target_path'])
+            expected_match = row['expected_match'].strip().lower() in ('1', 'true', 'yes')
+            pairs.append((model_path, target_path, expected_match))
+    if not pairs:
+        raise ValueError("No labelled pairs in {}".format(path))
+    logging.info("Loaded {} labelled pairs".format(len(pairs)))
+    return pairs
+
+
+def load_parameter_space(path: str):
+
+    with open(path) as space_file:
+        space = json.load(space_file)
+    for name, values in space.items():
+        if not isinstance(values, list) or not values:
+            raise ValueError("Parameter {} must be given a non-empty list of values to try".format(name))
+    # Validates the parameter names and values, since a typo would otherwise only show up in the middle
+    # of the sweep, or silently sweep nothing.
+    for name, values in space.items():
+        for value in values:
+            pipeline_config.config_from_dict({name: value})
+    # Order the parameters by stage so that neighbouring configurations share as many stages as possible.
+    stage_order = [name for _, parameter_names in STAGES for name in parameter_names] + list(pipeline_config.CASCADE_PARAMETERS)
+    return [(name, space[name]) for name in stage_order if name in space]
+
+
+def grid_configurations(parameter_space, base_config):
+
+    names = [name for name, _ in parameter_space]
+    for values in itertools.product(*[values for _, values in parameter_space]):
+        yield pipeline_config.config_from_dict(dict(zip(names, values)), base_config)
+
+
+def random_configurations(parameter_space, base_config, samples: int, seed: int):
+
+    # Pick distinct points of the grid without listing the whole grid, since it can get very large.
+    sizes = [len(values) for _, values in parameter_space]
+    grid_size = 1
+    for size in sizes:
+        grid_size *= size
+    rng = random.Random(seed)
+    for grid_index in sorted(rng.sample(range(grid_size), min(samples, grid_size))):
+        values = {}
+        for (name, parameter_values), size in zip(reversed(parameter_space), reversed(sizes)):
+            grid_index, value_index = divmod(grid_index, size)
+            values[name] = parameter_values[value_index]
+        yield pipeline_config.config_from_dict(values, base_config)
+
+
+def run_cached_stage(cache: dict, key, stage_function, *args):
+
+    # Returns the result of the stage together with the time it took to calculate. On a cache hit the
+    # stored time is returned, so the latency of a configuration doesn't depend on what was run before it.
+    if key not in cache:
+        start = time.perf_counter()
+        result = stage_function(*args)
+        cache[key] = (result, time.perf_counter() - start)
+    return cache[key]
+
+
+def drop_stale_stages(cache: dict, keys: dict):
+
+    # Results of a stage are only useful for configurations with the same upstream parameters. Since the
+    # configurations are ordered so that neighbours share as many stages as possible, anything computed
+    # for other upstream parameters is unlikely to be needed again and would otherwise be kept for the
+    # rest of the sweep.
+    for key in list(cache):
+        stage_key = keys.get(key[0])
+        if stage_key is not None and key[:len(stage_key)] != stage_key:
+            del cache[key]
+
+
+def stage_keys(config):
+
+    keys = {}
+    upstream_values = ()
+    for stage_name, parameter_names in STAGES:
+        upstream_values += used_parameter_values(config, parameter_names)
+        keys[stage_name] = (stage_name,) + upstream_values
+    # The raw images are kept only as long as the filtered images made from them. When the loading
+    # parameters change, they are read again instead of keeping the whole set of images in memory.
+    keys['reading'] = ('reading',) + used_parameter_values(config, pipeline_config.LOADING_PARAMETERS)
+    # The early rejection is not part of the chain above. It doesn't use the filtered full size images, and
+    # the later stages give the same results whether it is enabled or not.
+    keys['early_rejection'] = (('early_rejection',) + used_parameter_values(config, pipeline_config.EXTRACTION_PARAMETERS) +
+                               used_parameter_values(config, pipeline_config.CASCADE_PARAMETERS))
+    return keys
+
+
+def used_parameter_values(config, parameter_names):
+    return pipeline_config.parameter_values(config, pipeline_config.get_used_parameter_names(config, parameter_names))
+
+
+def run_pair(cache: dict, config, model_path: str, target_path: str):
+
+    keys = stage_keys(config)
+    pair = (model_path, target_path)
+    timings = {}
+    raw_model_image, model_reading_time = run_cached_stage(cache, keys['reading'] + (model_path,), read_gray_scale_image, model_path)
+    raw_target_image, target_reading_time = run_cached_stage(cache, keys['reading'] + (target_path,), read_gray_scale_image, target_path)
+    timings['reading'] = model_reading_time + target_reading_time
+
+    if config.cascade_enabled:
+        early_rejection_model_descriptors, early_rejection_preparation_time = run_cached_stage(
+            cache, keys['early_rejection'] + (model_path,), early_rejection.get_early_rejection_model_descriptors, raw_model_image, config
+        )
+        passed, early_rejection_time = run_cached_stage(
+            cache, keys['early_rejection'] + pair, early_rejection.passes_early_rejection, early_rejection_model_descriptors, raw_target_image, config
+        )
+        timings['early_rejection'] = early_rejection_preparation_time + early_rejection_time
+        if not passed:
+            return False, timings, []
+
+    model_image, model_preprocessing_time = run_cached_stage(cache, keys['loading'] + (model_path,), preprocess_gray_scale_image, raw_model_image, config)
+    target_image, target_preprocessing_time = run_cached_stage(cache, keys['loading'] + (target_path,), preprocess_gray_scale_image, raw_target_image, config)
+    model_features, model_extraction_time = run_cached_stage(cache, keys['extraction'] + (model_path,), get_keypoints_and_descriptors, model_image, config)
+    target_features, target_extraction_time = run_cached_stage(cache, keys['extraction'] + (target_path,), get_keypoints_and_descriptors, target_image, config)
+    model_keypoints, model_descriptors = model_features
+    target_keypoints, target_descriptors = target_features
+
+    unfiltered_matches, matching_time = run_cached_stage(cache, keys['matching'] + pair, image_matching.do_2_nn_brute_force_matching, model_descriptors, target_descriptors)
+    ratio_filtered_matches, ratio_filtering_time = run_cached_stage(cache, keys['ratio_filtering'] + pair, image_matching.do_2_nn_ratio_filtering, unfiltered_matches, config)
+    duplicate_filtered_matches, duplicate_removal_time = run_cached_stage(cache, keys['duplicate_removal'] + pair, image_matching.remove_duplicate_mappings, ratio_filtered_matches)
+    homography_filtered_matches, homography_time = run_cached_stage(cache, keys['homography'] + pair, image_matching.filter_with_homography, duplicate_filtered_matches, model_keypoints, target_keypoints, config)
+
+    timings.update({
+        'preprocessing': model_preprocessing_time + target_preprocessing_time,
+        'extraction': model_extraction_time + target_extraction_time,
+        'matching': matching_time,
+        'ratio_filtering': ratio_filtering_time,
+        'duplicate_removal': duplicate_removal_time,
+        'homography': homography_time,
+    })
+    # Keypoint counts of the images that went through the full extraction.
+    keypoint_counts = [len(model_keypoints), len(target_keypoints)]
+    return len(homography_filtered_matches) > 0, timings, keypoint_counts
+
+
+def evaluate_configuration(cache: dict, config, pairs):
+
+    drop_stale_stages(cache, stage_keys(config))
+    true_positives = false_positives = true_negatives = false_negatives = 0
+    total_latency = total_negative_latency = total_extraction_time = 0.0
+    keypoint_counts = []
+    for model_path, target_path, expected_match in pairs:
+        found_match, timings, pair_keypoint_counts = run_pair(cache, config, model_path, target_path)
+        latency = sum(timings.values())
+        total_latency += latency
+        if not expected_match:
+            total_negative_latency += latency
+        total_extraction_time += timings.get('extraction', 0.0)
+        keypoint_counts += pair_keypoint_counts
+        if found_match and expected_match:
+            true_positives += 1
+        elif found_match:
+            false_positives += 1
+        elif expected_match:
+            false_negatives += 1
+        else:
+            true_negatives += 1
+
+    positives = true_positives + false_negatives
+    negatives = len(pairs) - positives
+    extracted_image_count = max(len(keypoint_counts), 1)
+    return {
+        'config': config,
+        'mean_latency': total_latency / len(pairs),
+        'mean_negative_latency': total_negative_latency / negatives if negatives else 0.0,
+        # These are per image that went through the full extraction rather than per pair.
+        'mean_extraction_time': total_extraction_time / extracted_image_count,
+        'mean_keypoint_count': float(sum(keypoint_counts)) / extracted_image_count,
+        'accuracy': float(true_positives + true_negatives) / len(pairs),
+        'recall': float(true_positives) / positives if positives else 1.0,
+        'false_positives': false_positives,
+    }
+
+
+def pareto_frontier(results):
+
+    # A configuration is on the frontier if no other configuration is both at least as fast and at least
+    # as accurate, and strictly better in one of the two.
+    frontier = []
+    for result in sorted(results, key=lambda r: (r['mean_latency'], -r['accuracy'])):
+        if not frontier or result['accuracy'] > frontier[-1]['accuracy']:
+            frontier.append(result)
+    return frontier
+
+
+def fastest_meeting_recall(results, min_recall: float):
+
+    qualifying_results = [result for result in results if result['recall'] >= min_recall]
+    if not qualifying_results:
+        return None
+    return min(qualifying_results, key=lambda r: (r['mean_latency'], -r['accuracy']))
+
+
+def describe_differences(config, base_config):
+
+    base_values = pipeline_config.config_to_dict(base_config)
+    differences = ["{}={}".format(name, value) for name, value in pipeline_config.config_to_dict(config).items() if base_values[name] != value]
+    return ", ".join(differences) if differences else "(base configuration)"
+
+
+def log_result(result, base_config):
+    logging.info("  {:8.1f} ms  ({:8.1f} ms on negatives)  accuracy {:.3f}  recall {:.3f}  false positives {}  {}".format(
+        result['mean_latency'] * 1000, result['mean_negative_latency'] * 1000, result['accuracy'], result['recall'], result['false_positives'],
+        describe_differences(result['config'], base_config)
+    ))
+
+
+def run_sweep(pairs, configurations, base_config, min_recall: float):
+
+    cache = {}
+    results = []
+    for config in configurations:
+        result = evaluate_configuration(cache, config, pairs)
+        logging.debug("Evaluated {}: {}".format(describe_differences(config, base_config), result))
+        results.append(result)
+    logging.info("Evaluated {} configurations on {} pairs".format(len(results), len(pairs)))
+
+    logging.info("Pareto frontier of mean latency per pair vs. accuracy:")
+    for result in pareto_frontier(results):
+        log_result(result, base_config)
+
+    best_result = fastest_meeting_recall(results, min_recall)
+    if best_result is None:
+        logging.warning("No configuration reached a recall of {}".format(min_recall))
+    else:
+        logging.info("Fastest configuration with recall of at least {}:".format(min_recall))
+        log_result(best_result, base_config)
+    return best_result
+
+
+def compare_detectors(pairs, base_config):
+
+    # Runs the base configuration once with each detector, so the detectors are compared on the same
+    # images with the same loading and matching parameters.
+    cache = {}
+    logging.info("Comparison of detectors (extraction time and keypoint count are per image):")
+    for detector in get_available_detectors():
+        result = evaluate_configuration(cache, replace(base_config, detector=detector), pairs)
+        logging.info("  {:<6} extraction {:8.1f} ms  keypoints {:8.1f}  total {:8.1f} ms  accuracy {:.3f}  recall {:.3f}  false positives {}".format(
+            detector, result['mean_extraction_time'] * 1000, result['mean_keypoint_count'], result['mean_latency'] * 1000,
+            result['accuracy'], result['recall'], result['false_positives']
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-l',
+        '--log',
+        dest='loglevel',
+        default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+        help='Set the logging level')
+    parser.add_argument(
+        '-p',
+        '--pairs',
+        dest='pairs_path',
+        type=str,
+        required=True,
+        help='Path to a CSV file with the columns model_path, target_path, and expected_match.'
+    )
+    parser.add_argument(
+        '-s',
+        '--space',
+        dest='space_path',
+        type=str,
+        help='Path to a JSON file mapping parameter names to lists of values to try.'
+    )
+    parser.add_argument(
+        '--compare-detectors',
+        dest='compare_detectors',
+        action='store_true',
+        help='Instead of a sweep, compare extraction time, keypoint count, and accuracy of every available detector.'
+    )
+    parser.add_argument(
+        '-c',
+        '--config',
+        dest='config_path',
+        type=str,
+        help='Path to a JSON file with the base parameters. Parameters that are not given keep their default values.'
+    )
+    parser.add_argument(
+        '--search',
+        dest='search',
+        default='grid',
+        choices=['grid', 'random'],
+        help='Try every combination of parameter values, or a random selection of them.'
+    )
+    parser.add_argument(
+        '--samples',
+        dest='samples',
+        type=int,
+        default=20,
+        help='Number of configurations to try with random search.'
+    )
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        type=int,
+        default=0,
+        help='Seed for random search.'
+    )
+    parser.add_argument(
+        '--min-recall',
+        dest='min_recall',
+        type=float,
+        default=0.9,
+        help='Recall that the chosen configuration must reach.'
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        dest='output_path',
+        type=str,
+        help='Write the chosen configuration to this path. It can be given to main.py with --config.'
+    )
+    args = parser.parse_args()
+    if not args.compare_detectors and not args.space_path:
+        parser.error('the following arguments are required: -s/--space')
+
+    configure_logging(args.loglevel)
+
+    try:
+        base_config = pipeline_config.load_config(args.config_path) if args.config_path else pipeline_config.DEFAULT_CONFIG
+        pairs = load_labelled_pairs(args.pairs_path)
+        parameter_space = load_parameter_space(args.space_path) if not args.compare_detectors else None
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        parser.error('could not read input: {}'.format(e))
+
+    try:
+        if args.compare_detectors:
+            compare_detectors(pairs, base_config)
+        else:
+            if args.search == 'grid':
+                configurations = grid_configurations(parameter_space, base_config)
+            else:
+                configurations = random_configurations(parameter_space, base_config, args.samples, args.seed)
+            best_result = run_sweep(pairs, configurations, base_config, args.min_recall)
+            if best_result is not None and args.output_path:
+                pipeline_config.save_config(best_result['config'], args.output_path)
+                logging.info("Wrote chosen configuration to {}".format(args.output_path))
+    except:
+        logging.exception('Unexpected exception occured!')
@@ -0,0 +1,239 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import PipelineConfig
+from dataclasses import dataclass
+import early_rejection
+from feature_detection_and_description import get_keypoints_and_descriptors
+from image_loading import preprocess_gray_scale_image, read_gray_scale_image
+import image_matching
+import instrumentation
+import logging
+import result_cache
+import threading
+
+# The steps of finding a model in a target image, each wrapped in a timer. This is the module that pulls
+# in OpenCV and NumPy, so main.py only imports it once it knows it has something to do.
+
+
+def read_image(path: str):
+    with instrumentation.timed('reading'):
+        return read_gray_scale_image(path)
+
+
+def preprocess_image(image, config: PipelineConfig):
+    with instrumentation.timed('preprocessing'):
+        return preprocess_gray_scale_image(image, config)
+
+
+def extract_features(image, config: PipelineConfig):
+    with instrumentation.timed('extraction'):
+        return get_keypoints_and_descriptors(image, config)
+
+
+def match_features(model_keypoints, model_descriptors, target_keypoints, target_descriptors, config: PipelineConfig, timer_prefix: str = ''):
+
+    # Returns the matches that are left after each filtering step, so that they can be inspected separately.
+    with instrumentation.timed(timer_prefix + 'matching'):
+        unfiltered_matches = image_matching.do_2_nn_brute_force_matching(model_descriptors, target_descriptors)
+    with instrumentation.timed(timer_prefix + 'ratio_filtering'):
+        ratio_filtered_matches = image_matching.do_2_nn_ratio_filtering(unfiltered_matches, config)
+    with instrumentation.timed(timer_prefix + 'duplicate_removal'):
+        duplicate_filtered_matches = image_matching.remove_duplicate_mappings(ratio_filtered_matches)
+    with instrumentation.timed(timer_prefix + 'homography'):
+        homography_filtered_matches, homography = image_matching.filter_with_homography_and_get_homography(
+            duplicate_filtered_matches, model_keypoints, target_keypoints, config
+        )
+    return unfiltered_matches, ratio_filtered_matches, duplicate_filtered_matches, homography_filtered_matches, homography
+
+
+def prepare_early_rejection(raw_model_image, config: PipelineConfig):
+
+    # Returns the model descriptors used for early rejection, or None if it isn't enabled.
+    if not config.cascade_enabled:
+        return None
+    with instrumentation.timed('early_rejection_preparation'):
+        return early_rejection.get_early_rejection_model_descriptors(raw_model_image, config)
+
+
+def passes_early_rejection(early_rejection_model_descriptors, raw_target_image, config: PipelineConfig):
+
+    if not config.cascade_enabled:
+        return True
+    with instrumentation.timed('early_rejection'):
+        passed = early_rejection.passes_early_rejection(early_rejection_model_descriptors, raw_target_image, config)
+    if not passed:
+        instrumentation.increment('rejections.early_rejection')
+    return passed
+
+
+@dataclass
+class PreparedModel:
+    keypoints: list
+    descriptors: object
+    early_rejection_descriptors: object
+    # Hash of the model file for looking up cached results, or None if the result cache is not enabled.
+    content_hash: str
+
+
+def prepare_model(path_to_model: str, config: PipelineConfig):
+
+    # Everything about the model that stays the same no matter which target it is compared to.
+    raw_model_image = read_image(path_to_model)
+    model_image = preprocess_image(raw_model_image, config)
+    model_keypoints, model_descriptors = extract_features(model_image, config)
+    early_rejection_model_descriptors = prepare_early_rejection(raw_model_image, config)
+    content_hash = result_cache.hash_file(path_to_model) if result_cache.is_result_cache_enabled() else None
+    return PreparedModel(model_keypoints, model_descriptors, early_rejection_model_descriptors, content_hash)
+
+
+def prepare_models(paths_to_models, config: PipelineConfig, thread_count: int):
+
+    # Like the matching, most of the model preparation happens inside OpenCV, so it can be done in threads.
+    with ThreadPoolExecutor(thread_count) as executor:
+        prepared_models = executor.map(prepare_model, paths_to_models, [config] * len(paths_to_models))
+        return dict(zip(paths_to_models, prepared_models))
+
+
+def find_model_features_in_target(model: PreparedModel, path_to_target: str, config: PipelineConfig):
+
+    # Runs everything that has to be done per target. Returns the matches that are left after all
+    # filtering and the homography, which is None if the model wasn't found.
+    raw_target_image = read_image(path_to_target)
+    if not passes_early_rejection(model.early_rejection_descriptors, raw_target_image, config):
+        return [], None
+    target_image = preprocess_image(raw_target_image, config)
+    target_keypoints, target_descriptors = extract_features(target_image, config)
+    return match_features(model.keypoints, model.descriptors, target_keypoints, target_descriptors, config)[-2:]
+
+
+def verify_model_in_target(model: PreparedModel, path_to_target: str, config: PipelineConfig):
+
+    # Returns a result in the format described in result_cache.py. If the result cache is enabled and
+    # the same model and target have been seen before with the same parameters, nothing else is done.
+    # Targets are counted before the lookup, so that the count includes the ones found in the cache.
+    instrumentation.increment('targets')
+    result_key = None
+    if result_cache.is_result_cache_enabled():
+        with instrumentation.timed('result_cache'):
+            result_key = result_cache.get_result_key(model.content_hash, result_cache.hash_file(path_to_target), config)
+            result = result_cache.get_cached_result(result_key)
+        if result is not None:
+            return result
+
+    result = make_result(*find_model_features_in_target(model, path_to_target, config))
+    if result_key is not None:
+        result_cache.store_result(result_key, result)
+    return result
+
+
+def make_result(homography_filtered_matches, homography):
+    return {
+        'match': len(homography_filtered_matches) > 0,
+        'inlier_count': len(homography_filtered_matches),
+        'homography': homography.tolist() if homography is not None else None,
+    }
+
+
+def is_confident_result(result, confident_inlier_count: int):
+    return confident_inlier_count is not None and result['match'] and result['inlier_count'] >= confident_inlier_count
+
+
+def find_best_model_in_target(models: dict, path_to_target: str, config: PipelineConfig, thread_count: int, confident_inlier_count: int = None):
+
+    # Checks one target against several prepared models, given as a dict from name to PreparedModel.
+    # Returns the name of the model found with the most matches (or None) and a dict with the result of
+    # every model that was checked. If confident_inlier_count is given, models that haven't been checked
+    # yet are skipped as soon as one model is found with at least that many matches.
+    instrumentation.increment('targets')
+    results = {}
+    result_keys = {}
+    if result_cache.is_result_cache_enabled():
+        with instrumentation.timed('result_cache'):
+            target_hash = result_cache.hash_file(path_to_target)
+            for name, model in models.items():
+                result_keys[name] = result_cache.get_result_key(model.content_hash, target_hash, config)
+                cached_result = result_cache.get_cached_result(result_keys[name])
+                if cached_result is not None:
+                    results[name] = cached_result
+
+    remaining_models = {name: model for name, model in models.items() if name not in results}
+    if remaining_models and not any(is_confident_result(result, confident_inlier_count) for result in results.values()):
+        new_results = match_models_in_target(remaining_models, path_to_target, config, thread_count, confident_inlier_count)
+        for name, result in new_results.items():
+            if name in result_keys:
+                result_cache.store_result(result_keys[name], result)
+        results.update(new_results)
+
+    found_results = {name: result for name, result in results.items() if result['match']}
+    best_model_name = max(found_results, key=lambda name: found_results[name]['inlier_count']) if found_results else None
+    return best_model_name, results
+
+
+def match_models_in_target(models: dict, path_to_target: str, config: PipelineConfig, thread_count: int, confident_inlier_count: int = None):
+
+    # The target is read, filtered, and described only once, no matter how many models there are.
+    results = {}
+    raw_target_image = read_image(path_to_target)
+    if config.cascade_enabled:
+        with instrumentation.timed('early_rejection'):
+            early_rejection_target_descriptors = early_rejection.get_early_rejection_target_descriptors(raw_target_image, config)
+            for name, model in models.items():
+                if not early_rejection.has_enough_early_rejection_matches(model.early_rejection_descriptors, early_rejection_target_descriptors, config):
+                    instrumentation.increment('rejections.early_rejection')
+                    results[name] = make_result([], None)
+        models = {name: model for name, model in models.items() if name not in results}
+        if not models:
+            return results
+
+    target_image = preprocess_image(raw_target_image, config)
+    target_keypoints, target_descriptors = extract_features(target_image, config)
+    # Matching and RANSAC spend nearly all their time inside OpenCV, which releases the GIL, so threads can
+    # run them for different models in parallel. Unlike worker processes, threads can all use the same
+    # target keypoints and descriptors without copying them. The descriptors are made read-only to make
+    # sure none of the threads changes them under the others.
+    if target_descriptors is not None:
+        target_descriptors.setflags(write=False)
+
+    # The models are matched at the same time, so the timings of the single models overlap and add up to
+    # more than the time it actually took. That's why they are kept separate from the time of the whole
+    # fan-out and from the timings of matching a single model.
+    confident_match_found = threading.Event()
+    failed_model_names = []
+    with instrumentation.timed('model_fan_out'), ThreadPoolExecutor(thread_count) as executor:
+        futures = {
+            executor.submit(match_model_with_target_features, model, target_keypoints, target_descriptors, config, confident_inlier_count, confident_match_found): name
+            for name, model in models.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            if future.cancelled():
+                continue
+            # One model failing shouldn't throw away the results of the others.
+            try:
+                result = future.result()
+            except:
+                logging.exception('Unexpected exception occured while matching model {}!'.format(name))
+                failed_model_names.append(name)
+                continue
+            if result is not None:
+                results[name] = result
+            if confident_match_found.is_set():
+                for remaining_future in futures:
+                    remaining_future.cancel()
+    if failed_model_names:
+        instrumentation.increment('models_failed', len(failed_model_names))
+    skipped_model_count = len(models) - len([name for name in models if name in results or name in failed_model_names])
+    if skipped_model_count:
+        logging.debug("Skipped {} models after finding a confident match".format(skipped_model_count))
+        instrumentation.increment('models_skipped', skipped_model_count)
+    return results
+
+
+def match_model_with_target_features(model: PreparedModel, target_keypoints, target_descriptors, config: PipelineConfig, confident_inlier_count: int, confident_match_found: threading.Event):
+
+    # A model that was already waiting when a confident match was found doesn't need to be checked.
+    if confident_match_found.is_set():
+        return None
+    result = make_result(*match_features(model.keypoints, model.descriptors, target_keypoints, target_descriptors, config, 'per_model.')[-2:])
+    if is_confident_result(result, confident_inlier_count):
+        confident_match_found.set()
+    return result
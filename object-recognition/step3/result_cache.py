@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from config import PipelineConfig, config_to_dict, get_used_parameter_names
+import hashlib
+import instrumentation
+import json
+import logging
+import os
+import threading
+
+# The same model and target are sometimes checked more than once, e.g. when a request is retried. Since
+# the pipeline always gives the same result for the same images and parameters, the result can be stored
+# and returned right away the next time. Results are kept in memory, with the least recently used ones
+# dropped when there are too many, and optionally also as files in a directory, so that they survive
+# restarts and can be shared between processes.
+#
+# A result is a dict with the keys 'match' (True/False), 'inlier_count' (the number of matches left after
+# all filtering), and 'homography' (a 3 x 3 list mapping target points to model points, or None).
+
+_entries = OrderedDict()
+_max_entries = 0
+_directory = None
+_lock = threading.Lock()
+
+
+def configure_result_cache(max_entries: int, directory: str = None):
+
+    global _max_entries, _directory
+    _max_entries = max_entries
+    _directory = directory
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with _lock:
+        while len(_entries) > _max_entries:
+            _entries.popitem(last=False)
+    logging.debug("Result cache configured with {} entries in memory and directory {}".format(max_entries, directory))
+
+
+def is_result_cache_enabled():
+    return _max_entries > 0 or _directory is not None
+
+
+def hash_file(path: str):
+
+    # The key is based on the contents of the file rather than its path, so that the same image uploaded
+    # twice under different names is still found in the cache.
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_result_key(model_hash: str, target_hash: str, config: PipelineConfig):
+
+    # Every parameter that is used is part of the key, since changing any of them can change the result.
+    # Parameters that aren't used, e.g. those of the other detectors, are left out so that they don't
+    # split the cache. The version of OpenCV is also part of the key, since its detectors and RANSAC can
+    # give different results after an upgrade. OpenCV is only imported here, so that main.py can configure
+    # the cache before importing it.
+    import cv2
+    values = config_to_dict(config)
+    used_values = {name: values[name] for name in get_used_parameter_names(config, values)}
+    parameters = json.dumps(dict(used_values, opencv_version=cv2.__version__), sort_keys=True)
+    return hashlib.sha256("\n".join([model_hash, target_hash, parameters]).encode('utf-8')).hexdigest()
+
+
+def get_cached_result(key: str):
+
+    with _lock:
+        result = _entries.get(key)
+        if result is not None:
+            _entries.move_to_end(key)
+    if result is not None:
+        instrumentation.increment('result_cache.hits')
+        return result
+
+    if _directory:
+        try:
+            with open(os.path.join(_directory, key + '.json')) as result_file:
+                result = json.load(result_file)
+            if not is_valid_result(result):
+                raise ValueError("{} is not a result".format(result))
+        except FileNotFoundError:
+            pass
+        except (ValueError, OSError):
+            # E.g. a file left truncated by a full disk, or one that isn't a result at all. It is treated
+            # as a miss, so the result is calculated again and the file is overwritten with it.
+            logging.warning("Could not read cached result {}, ignoring it".format(key))
+        else:
+            _remember(key, result)
+            instrumentation.increment('result_cache.hits')
+            instrumentation.increment('result_cache.disk_hits')
+            return result
+
+    instrumentation.increment('result_cache.misses')
+    return None
+
+
+def is_valid_result(result):
+    return (isinstance(result, dict) and isinstance(result.get('match'), bool) and isinstance(result.get('inlier_count'), int) and
+            'homography' in result and (result['homography'] is None or isinstance(result['homography'], list)))
+
+
+def store_result(key: str, result: dict):
+
+    _remember(key, result)
+    if _directory:
+        # Write to a temporary file first and then rename it, so that another process never reads a
+        # half-written result.
+        path = os.path.join(_directory, key + '.json')
+        temporary_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(temporary_path, 'w') as result_file:
+            json.dump(result, result_file)
+        os.replace(temporary_path, path)
+
+
+def _remember(key: str, result: dict):
+
+    if _max_entries <= 0:
+        return
+    with _lock:
+        _entries[key] = result
+        _entries.move_to_end(key)
+        eviction_count = max(len(_entries) - _max_entries, 0)
+        for _ in range(eviction_count):
+            _entries.popitem(last=False)
+    if eviction_count:
+        instrumentation.increment('result_cache.evictions', eviction_count)